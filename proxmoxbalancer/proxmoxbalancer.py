@@ -5,7 +5,10 @@
 #
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import heapq
 import locket
 import operator
 import os
@@ -13,6 +16,14 @@ import sys
 import time
 import yaml
 from proxmoxer import ProxmoxAPI
+from proxmoxer.core import ResourceException
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+_GB = 1024 * 1024 * 1024
 
 
 class ProxmoxBalancer:
@@ -21,6 +32,17 @@ class ProxmoxBalancer:
     node_list = {}
     dry = False
     proxmox = False
+    _total_nodes = 0
+    _total_points = 0
+    _total_used_points = 0
+    _rule_index = {}
+    _separate_rules = []
+    _unite_rules = []
+    _vm_to_separate_rules = {}
+    _vm_to_unite_rules = {}
+    _candidates_cache = {}
+    _vm_to_node = {}
+    _task_endpoints = {}
 
     def __init__(self):
         # Read args.
@@ -41,7 +63,7 @@ class ProxmoxBalancer:
         # Read config, sanitize, fire up the API.
         with open(args.config, "r") as stream:
             try:
-                config = yaml.safe_load(stream)
+                config = yaml.load(stream, Loader=SafeLoader)
                 if "method" not in config:
                     config["method"] = "current"
                 if "allowed_disparity" not in config:
@@ -54,11 +76,14 @@ class ProxmoxBalancer:
                     config["rules"]["separate"] = {}
                 if "port" not in config:
                     config["port"] = 8006
+                if "poll_interval_max" not in config:
+                    config["poll_interval_max"] = 10
             except yaml.YAMLError as exc:
                 print(exc)
                 sys.exit(1)
 
         self.config = config
+        self.build_rule_index()
 
         if "token_name" in config and "token_secret" in config:
             self.proxmox = ProxmoxAPI(
@@ -80,23 +105,67 @@ class ProxmoxBalancer:
                     verify_ssl=False,
                     )
 
+    # Parse the rules once, building a lookup of VM name to rule.
+    def build_rule_index(self):
+        rules = self.config["rules"]
+        self._separate_rules = [
+            frozenset(rule.split(",")) for rule in rules.get("separate", [])
+        ]
+        self._unite_rules = [
+            frozenset(rule.split(",")) for rule in rules.get("unite", [])
+        ]
+
+        # Pins take precedence over separate rules, which take precedence over
+        # unite rules, so only the first rule found for a VM is kept.
+        self._rule_index = {}
+        for rule in rules.get("pin", []):
+            pin = rule.split(":")
+            self._rule_index.setdefault(pin[0], {"type": "pinned", "node": pin[1]})
+        for rule in self._separate_rules:
+            for vm_name in rule:
+                self._rule_index.setdefault(vm_name, {"type": "separate", "rule": rule})
+        for rule in self._unite_rules:
+            for vm_name in rule:
+                self._rule_index.setdefault(vm_name, {"type": "unite", "rule": rule})
+
+        # For each VM, the other members of every separate/unite rule it is in.
+        self._vm_to_separate_rules = collections.defaultdict(list)
+        for rule in self._separate_rules:
+            for vm_name in rule:
+                self._vm_to_separate_rules[vm_name].append(rule - {vm_name})
+        self._vm_to_unite_rules = collections.defaultdict(list)
+        for rule in self._unite_rules:
+            for vm_name in rule:
+                self._vm_to_unite_rules[vm_name].append(rule - {vm_name})
+
     # Get various useful sum.
+    # The totals are cached by regenerate_lists(), migrations only move points
+    # between nodes so the sums stay valid for the lifetime of a pass.
     def get_totals(self):
         total_disparity = 0
-        total_nodes = len(self.node_list)
-        total_points = sum([self.node_list[node]["points"] for node in self.node_list])
-        total_used_points = sum(
-            [self.node_list[node]["used_points"] for node in self.node_list]
-        )
-        avg_points = (total_used_points / total_nodes) + 0.0
+        avg_points = (self._total_used_points / self._total_nodes) + 0.0
         return (
             total_disparity,
-            total_nodes,
-            total_points,
-            total_used_points,
+            self._total_nodes,
+            self._total_points,
+            self._total_used_points,
             avg_points,
         )
 
+    # Recalculate the cached totals from the node list.
+    def update_totals(self):
+        total_nodes = 0
+        total_points = 0
+        total_used_points = 0
+        for node in self.node_list.values():
+            total_nodes += 1
+            total_points += node["points"]
+            total_used_points += node["used_points"]
+
+        self._total_nodes = total_nodes
+        self._total_points = total_points
+        self._total_used_points = total_used_points
+
     # Calculate the overall imbalance in the cluster, this can be useful for
     # determining if we should even run Balance.
     def calculate_imbalance(self):
@@ -108,91 +177,56 @@ class ProxmoxBalancer:
             total_used_points,
             avg_points,
         ) = self.get_totals()
-        for node in self.node_list:
-            points = self.node_list[node]["used_points"]
+        for node_name, node in self.node_list.items():
+            points = node["used_points"]
             total_disparity += abs(avg_points - points)
             disparity = abs(100 - ((points / avg_points) * 100))
             if disparity > 30:
-                print("Found imbalance in node %s (%i" % (node, disparity) + "%)")
+                print("Found imbalance in node %s (%i" % (node_name, disparity) + "%)")
 
         return total_disparity
 
+    # Work out which hosts a VM could move to without breaking the rules.
+    # This is cached until balance_pass() plans the next move.
+    def get_rule_candidates(self, current_node, vm_name):
+        key = (vm_name, current_node)
+        if key not in self._candidates_cache:
+            separate = self._vm_to_separate_rules.get(vm_name, ())
+            unite = self._vm_to_unite_rules.get(vm_name, ())
+            self._candidates_cache[key] = [
+                node_name
+                for node_name, node in self.node_list.items()
+                if node_name != current_node
+                and all(node["vms"].keys().isdisjoint(others) for others in separate)
+                and all(node["vms"].keys() >= others for others in unite)
+            ]
+        return self._candidates_cache[key]
+
     # Work out the best host for a given VM.
     def calculate_best_host(self, current_node, vm_name):
-        # List of vms to keep separate.
-        rules = self.config["rules"]
-        separate = [rule.split(",") for rule in rules["separate"]]
-        unite = [rule.split(",") for rule in rules["unite"]]
+        node_list = self.node_list
+        current = node_list[current_node]
 
         # Get points.
-        vm = self.node_list[current_node]["vms"][vm_name]
-        points = vm["points"]
-
-        # Begin calculations.
-        (
-            total_disparity,
-            total_nodes,
-            total_points,
-            total_used_points,
-            avg_points,
-        ) = self.get_totals()
-        new_host = False
-        new_host_points = 0
-        for node_name in self.node_list:
-            if node_name == current_node:
-                continue
+        points = current["vms"][vm_name]["points"]
 
-            # Make sure we abide by the rules.
-            skip = False
-            for rule in separate:
-                if vm_name in rule:
-                    for vm in rule:
-                        if vm != vm_name and vm in self.node_list[node_name]["vms"]:
-                            skip = True
-            for rule in unite:
-                if vm_name in rule:
-                    for vm in rule:
-                        if vm != vm_name and vm not in self.node_list[node_name]["vms"]:
-                            skip = True
-            if skip:
-                continue
+        # Pick the least used host we are allowed to move to.
+        new_host = min(
+            self.get_rule_candidates(current_node, vm_name),
+            key=lambda node_name: node_list[node_name]["used_points"],
+            default=None,
+        )
+        if new_host is None:
+            return False
 
-            # This is not particularly forward-thinking but it will do for now.
-            new_points = self.node_list[node_name]["used_points"] + points
-            if new_points < self.node_list[current_node]["used_points"] and (
-                new_points < new_host_points or new_host_points == 0
-            ):
-                new_host = node_name
-                new_host_points = new_points
-        return new_host
+        # This is not particularly forward-thinking but it will do for now.
+        new_points = node_list[new_host]["used_points"] + points
+        if new_points < current["used_points"]:
+            return new_host
+        return False
 
     def get_rule(self, vm_name):
-        rules = self.config["rules"]
-
-        # First, check if we are pinned to a host.
-        if "pin" in rules:
-            pinned = [rule.split(":") for rule in rules["pin"]]
-            for rule in pinned:
-                if vm_name == rule[0]:
-                    return {"type": "pinned", "node": rule[1]}
-
-        # Now, see if we are separated from other VMs.
-        if "separate" in rules:
-            separate = [rule.split(",") for rule in rules["separate"]]
-            for rule in separate:
-                for vm in rule:
-                    if vm == vm_name:
-                        return {"type": "separate", "rule": rule}
-
-        # Should we unite with another vm?
-        if "unite" in rules:
-            unite = [rule.split(",") for rule in rules["unite"]]
-            for rule in unite:
-                for vm in rule:
-                    if vm == vm_name:
-                        return {"type": "unite", "rule": rule}
-
-        return {}
+        return self._rule_index.get(vm_name, {})
 
     # Is this host pinned?
     def is_pinned(self, vm_name):
@@ -201,48 +235,30 @@ class ProxmoxBalancer:
 
     # Should we separate this VM out from its current host?
     def should_separate(self, rule, vm_name, node_vms):
-        other_vms = [x for x in rule if x != vm_name]
-        return any(item in other_vms for item in node_vms)
+        return any(vm != vm_name and vm in node_vms for vm in rule)
 
     # Should we unite this VM with friends?
     def should_unite(self, rule, vm_name, node_vms):
-        other_vms = [x for x in rule if x != vm_name]
-        return not all(item in node_vms for item in other_vms)
+        return not all(vm == vm_name or vm in node_vms for vm in rule)
 
     # Given a list of candiate hosts, pick the one with the lowest score.
     def get_lowest_candidate(self, candidates):
-        lowest_point_score = 0
-        candidate_host = 0
-
-        # Pick the candidate with the lowest point score.
-        for candidate in candidates:
-            if candidate_host == 0:
-                candidate_host = candidate
-                lowest_point_score = self.node_list[candidate]["points"]
-            if self.node_list[candidate]["points"] > lowest_point_score:
-                candidate_host = candidate
-                lowest_point_score = self.node_list[candidate]["points"]
-
-        return candidate_host
+        return min(
+            candidates, key=lambda node: self.node_list[node]["points"], default=None
+        )
 
     # Keep united VMs together at all costs.
     def unite(self, rule, vm_name):
-        rule_vms = [x for x in rule]
-        candidates = [
-            x
-            for x in self.node_list
-            if any(item in rule_vms for item in self.node_list[x]["vms"])
-        ]
+        rule_nodes = {self._vm_to_node[x] for x in rule if x in self._vm_to_node}
+        candidates = [x for x in self.node_list if x in rule_nodes]
         return self.get_lowest_candidate(candidates)
 
     # Keep separated VMs apart at all costs.
     def separate(self, rule, vm_name):
-        other_vms = [x for x in rule if x != vm_name]
-        candidates = [
-            x
-            for x in self.node_list
-            if not any(item in other_vms for item in self.node_list[x]["vms"])
-        ]
+        other_nodes = {
+            self._vm_to_node[x] for x in rule if x != vm_name and x in self._vm_to_node
+        }
+        candidates = [x for x in self.node_list if x not in other_nodes]
         if len(candidates) <= 0:
             print(
                 "No suitable candidate host found for %s, perhaps you need more hosts."
@@ -252,11 +268,13 @@ class ProxmoxBalancer:
 
     # Runs a balance pass over the node list.
     def rule_pass(self):
-        operations = []
+        # Planned operations by VM name, so a VM moved twice is only migrated once.
+        operations = {}
 
         # Loop through every VM, check for rule violations.
-        for node_name in self.node_list:
-            for vm_name in self.node_list[node_name]["vms"]:
+        # Planned moves are applied to node_list as we go, so later checks see them.
+        for node_name, node in self.node_list.items():
+            for vm_name in list(node["vms"]):
                 # First, check we're abiding by the rules.
                 rule = self.get_rule(vm_name)
                 if "type" not in rule:
@@ -266,14 +284,14 @@ class ProxmoxBalancer:
 
                 # Deal with unite rules.
                 if rule["type"] == "unite" and self.should_unite(
-                    rule["rule"], vm_name, self.node_list[node_name]["vms"]
+                    rule["rule"], vm_name, node["vms"]
                 ):
                     print("Rule violation detected for '%s': Unite violation" % vm_name)
                     target = self.unite(rule["rule"], vm_name)
 
                 # Deal with separation rules.
                 if rule["type"] == "separate" and self.should_separate(
-                    rule["rule"], vm_name, self.node_list[node_name]["vms"]
+                    rule["rule"], vm_name, node["vms"]
                 ):
                     print(
                         "Rule violation detected for '%s': Separation violation"
@@ -294,61 +312,171 @@ class ProxmoxBalancer:
 
                 # If we have to move, do.
                 if target and target != node_name:
-                    operations.append(
-                        {"vm_name": vm_name, "host": node_name, "target": target}
-                    )
+                    vm = node["vms"].pop(vm_name)
+                    if vm_name not in operations:
+                        operations[vm_name] = {
+                            "vm_name": vm_name,
+                            "vmid": vm["vmid"],
+                            "host": node_name,
+                            "target": target,
+                        }
+                    elif operations[vm_name]["host"] == target:
+                        # Back where it started, no need to move it at all.
+                        del operations[vm_name]
+                    else:
+                        operations[vm_name]["target"] = target
 
-                    self.node_list[target]["vms"][vm_name] = self.node_list[node_name][
-                        "vms"
-                    ][vm_name]
+                    target_node = self.node_list[target]
+                    target_node["vms"][vm_name] = vm
+                    self._vm_to_node[vm_name] = target
 
-        return operations
+                    node["used_points"] -= vm["points"]
+                    target_node["used_points"] += vm["points"]
+
+        return list(operations.values())
 
     # Runs a balance pass over the node list.
     def balance_pass(self):
         operations = []
+        self._candidates_cache = {}
+
+        # Order each host's movable VMs from heaviest to lightest.
+        movable = {}
+        for node_name, node in self.node_list.items():
+            vms = node["vms"]
+            movable[node_name] = sorted(
+                [
+                    vm_name
+                    for vm_name in vms
+                    if vms[vm_name]["status"] != "stopped"
+                    and not self.is_pinned(vm_name)
+                ],
+                key=lambda vm_name: vms[vm_name]["points"],
+                reverse=True,
+            )
 
-        # Loop through every VM, if we find one that we can migrate to another host without
-        # making that hosts' total points greater than our own, do that.
-        for node_name in self.node_list:
-            for vm_name in self.node_list[node_name]["vms"]:
-                vm = self.node_list[node_name]["vms"][vm_name]
+        # Keep taking the busiest host and moving its heaviest VM that fits somewhere
+        # without making that hosts' total points greater than our own.
+        node_list = self.node_list
+        hot = [(-node["used_points"], x) for x, node in node_list.items()]
+        heapq.heapify(hot)
 
-                # Can we action this host?
-                if vm["status"] == "stopped" or self.is_pinned(vm_name):
-                    continue
+        # Track the imbalance as we go, and stop once it is acceptable.
+        (
+            total_disparity,
+            total_nodes,
+            total_points,
+            total_used_points,
+            avg_points,
+        ) = self.get_totals()
+        allowed_disparity = total_nodes * self.config["allowed_disparity"]
+        for node in node_list.values():
+            total_disparity += abs(avg_points - node["used_points"])
+
+        while hot and total_disparity > allowed_disparity:
+            used_points, node_name = heapq.heappop(hot)
+            node = node_list[node_name]
+            if -used_points != node["used_points"]:
+                # Stale entry, this host has been pushed again since.
+                continue
 
-                points = vm["points"]
+            for vm_name in movable[node_name]:
                 target = self.calculate_best_host(node_name, vm_name)
-
                 if target:
-                    operations.append(
-                        {"vm_name": vm_name, "host": node_name, "target": target}
-                    )
+                    break
+            else:
+                # Nothing left on this host can go anywhere better.
+                continue
+
+            movable[node_name].remove(vm_name)
+            vm = node["vms"].pop(vm_name)
+            operations.append(
+                {
+                    "vm_name": vm_name,
+                    "vmid": vm["vmid"],
+                    "host": node_name,
+                    "target": target,
+                }
+            )
 
-                    self.node_list[node_name]["used_points"] -= points
-                    self.node_list[target]["used_points"] += points
+            # Apply the move, so later rule checks see it.
+            target_node = node_list[target]
+            target_node["vms"][vm_name] = vm
+            self._vm_to_node[vm_name] = target
+            self._candidates_cache = {}
+
+            points = vm["points"]
+            total_disparity -= abs(avg_points - node["used_points"])
+            total_disparity -= abs(avg_points - target_node["used_points"])
+            node["used_points"] -= points
+            target_node["used_points"] += points
+            total_disparity += abs(avg_points - node["used_points"])
+            total_disparity += abs(avg_points - target_node["used_points"])
+            heapq.heappush(hot, (-node["used_points"], node_name))
+            heapq.heappush(hot, (-target_node["used_points"], target))
 
         return operations
 
     # Return the status of a given task.
+    # The API endpoint is kept while the task runs, as we poll it repeatedly.
     def task_status(self, host, taskid):
-        task = self.proxmox.nodes(host).tasks(taskid).status.get()
+        key = (host, taskid)
+        endpoint = self._task_endpoints.get(key)
+        if endpoint is None:
+            endpoint = self.proxmox.nodes(host).tasks(taskid).status
+            self._task_endpoints[key] = endpoint
+
+        task = endpoint.get()
+        status = "Unknown Task"
         if task and "status" in task:
-            return task["status"]
-        return "Unknown Task"
+            status = task["status"]
+        if status != "running":
+            del self._task_endpoints[key]
+        return status
 
     # Wait for a given to task to complete (or fail).
     def wait_for_task(self, host, taskid):
-        while self.task_status(host, taskid) == "running":
-            time.sleep(1)
+        self.wait_for_tasks([(host, taskid)])
+
+    # Wait for a list of (host, taskid) tasks to complete (or fail).
+    # Poll quickly at first, backing off for longer running tasks.
+    def wait_for_tasks(self, tasks):
+        delay = 0.1
+        while True:
+            tasks = [
+                (host, taskid)
+                for host, taskid in tasks
+                if self.task_status(host, taskid) == "running"
+            ]
+            if not tasks:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, self.config["poll_interval_max"])
+
+    # Split operations into batches where no two operations share a host, so
+    # each batch can be migrated in parallel. An operation always goes after
+    # the last batch it conflicts with, keeping the original order between them.
+    def batch_operations(self, operations):
+        batches = []
+        for operation in operations:
+            nodes = {operation["host"], operation["target"]}
+            index = 0
+            for i, (busy_nodes, batch) in enumerate(batches):
+                if not busy_nodes.isdisjoint(nodes):
+                    index = i + 1
+            if index == len(batches):
+                batches.append((set(), []))
+            batches[index][0].update(nodes)
+            batches[index][1].append(operation)
+        return [batch for busy_nodes, batch in batches]
 
     # Actually migrate a VM.
+    # Returns the (host, taskid) of the migration task if one was started.
     def run_migrate(self, operation, wait=False):
         vm_name = operation["vm_name"]
         host = operation["host"]
         target = operation["target"]
-        vmid = self.node_list[host]["vms"][vm_name]["vmid"]
+        vmid = operation["vmid"]
         data = {
             "target": target,
             "online": 1,
@@ -358,13 +486,13 @@ class ProxmoxBalancer:
             taskid = self.proxmox.nodes(host).qemu(vmid).migrate.post(**data)
             if wait:
                 self.wait_for_task(host, taskid)
+            return (host, taskid)
         else:
             print("Would move %s from %s to %s" % (vm_name, host, target))
 
     # Pretty print the points used.
     def pretty_print_points(self):
-        for name in self.node_list:
-            node = self.node_list[name]
+        for name, node in self.node_list.items():
             print(
                 "Found host %s with %i points (%i used)."
                 % (name, node["points"], node["used_points"])
@@ -375,23 +503,51 @@ class ProxmoxBalancer:
     # Each CPU core is worth 5 points, each GB ram is 1 point.
     def calculate_vm_points(self, vm):
         if self.config["method"] == "max":
-            return (vm["cpus"] * 5) + ((vm["maxmem"] / 1024 / 1024 / 1024) * 1)
-        return (vm["cpu"] * 5) + ((vm["mem"] / 1024 / 1024 / 1024) * 1)
+            return (vm["cpus"] * 5) + (vm["maxmem"] / _GB)
+        return (vm["cpu"] * 5) + (vm["mem"] / _GB)
+
+    # Fetch the VMs on each of the given nodes, grouped by node name.
+    def get_vms_by_node(self, node_names):
+        # Fetch every VM in the cluster in one call where we can.
+        vms_by_node = collections.defaultdict(list)
+        try:
+            for vm in self.proxmox.cluster.resources.get(type="vm"):
+                if vm["type"] != "qemu":
+                    continue
+                # The cluster resources endpoint calls the CPU count "maxcpu".
+                vm.setdefault("cpus", vm["maxcpu"])
+                vms_by_node[vm["node"]].append(vm)
+            return vms_by_node
+        except ResourceException as exc:
+            print("Cannot list cluster resources (%s), querying each node." % exc)
+
+        # Otherwise ask each node, these calls are independent so run them together.
+        def get_node_vms(node_name):
+            return list(self.proxmox.nodes(node_name).qemu.get())
+
+        workers = max(1, min(32, len(node_names)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            vms_by_node.update(zip(node_names, executor.map(get_node_vms, node_names)))
+        return vms_by_node
 
     # Generate node_list and vm_list.
     def regenerate_lists(self):
-        for node in self.proxmox.nodes.get():
+        self.vm_list = []
+        nodes = self.proxmox.nodes.get()
+        vms_by_node = self.get_vms_by_node([node["node"] for node in nodes])
+
+        for node in nodes:
             node_name = node["node"]
 
             self.node_list[node_name] = node
             self.node_list[node_name]["vms"] = {}
 
             # Calculate points.
-            points = (node["maxcpu"] * 5) + ((node["maxmem"] / 1024 / 1024 / 1024) * 1)
+            points = (node["maxcpu"] * 5) + (node["maxmem"] / _GB)
             self.node_list[node_name]["points"] = points
             self.node_list[node_name]["used_points"] = 0
 
-            for vm in self.proxmox.nodes(node_name).qemu.get():
+            for vm in vms_by_node[node_name]:
                 vm_name = vm["name"]
                 if vm["status"] == "running":
                     points = self.calculate_vm_points(vm)
@@ -407,8 +563,16 @@ class ProxmoxBalancer:
                     )
 
         # Order vm_list.
-        self.vm_list.sort(key=operator.itemgetter("points"))
-        self.vm_list.reverse()
+        self.vm_list.sort(key=operator.itemgetter("points"), reverse=True)
+
+        # Index which node each VM is on.
+        self._vm_to_node = {
+            vm_name: node_name
+            for node_name, node in self.node_list.items()
+            for vm_name in node["vms"]
+        }
+
+        self.update_totals()
 
     def balance(self):
         with locket.lock_file(self.config["infra_lock_file"], timeout=120):
@@ -419,11 +583,15 @@ class ProxmoxBalancer:
 
             # Fix rule violations, then balance.
             operations = self.rule_pass()
-            for operation in operations:
-                self.run_migrate(operation, wait=True)
-
-            # Get a new list of hosts and VMs.
-            self.regenerate_lists()
+            for batch in self.batch_operations(operations):
+                tasks = [self.run_migrate(operation) for operation in batch]
+                self.wait_for_tasks([task for task in tasks if task])
+
+            # rule_pass() has already moved the VMs in node_list, but if we really
+            # migrated anything get a new list of hosts and VMs in case a migration
+            # failed.
+            if operations and not self.dry:
+                self.regenerate_lists()
 
             # Okay, work out the imbalance here and run migrations.
             total_disparity = self.calculate_imbalance()